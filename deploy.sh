@@ -49,6 +49,29 @@ sam deploy \
 echo ""
 echo -e "${GREEN}✅ Deployment complete!${NC}"
 
+# Split any legacy single-file data into per-user objects (no-op once migrated)
+echo -e "${YELLOW}🔁 Migrating legacy data to per-user objects...${NC}"
+BUCKET_NAME=$(aws cloudformation describe-stacks \
+    --stack-name $STACK_NAME \
+    --region $REGION \
+    --query 'Stacks[0].Outputs[?OutputKey==`PermissionsBucket`].OutputValue' \
+    --output text)
+if [ -z "$BUCKET_NAME" ] || [ "$BUCKET_NAME" = "None" ]; then
+    echo -e "${RED}❌ Could not find the PermissionsBucket output of stack $STACK_NAME.${NC}"
+    exit 1
+fi
+
+# The migration imports the handlers, so run it with their dependencies installed
+MIGRATION_VENV=".aws-sam/migration-venv"
+python3 -m venv "$MIGRATION_VENV"
+"$MIGRATION_VENV/bin/pip" install --quiet -r src/requirements.txt
+if ! S3_BUCKET_NAME=$BUCKET_NAME AWS_DEFAULT_REGION=$REGION "$MIGRATION_VENV/bin/python" src/migrate_storage.py; then
+    echo -e "${RED}❌ Legacy data migration failed; see the output above. The new functions are live"
+    echo -e "   but cannot see users that were not migrated. Fix the problem and re-run:${NC}"
+    echo "   S3_BUCKET_NAME=$BUCKET_NAME $MIGRATION_VENV/bin/python src/migrate_storage.py"
+    exit 1
+fi
+
 # Get the API endpoint
 API_URL=$(aws cloudformation describe-stacks \
     --stack-name $STACK_NAME \
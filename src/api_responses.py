@@ -0,0 +1,22 @@
+"""Response bodies shared by the Lambda handlers"""
+import orjson
+import re
+
+# Names made of these characters only (profile first names, and the user IDs
+# generated from them) need no JSON escaping and can be placed in templates as-is
+NAME_RE = re.compile(r'[A-Za-z0-9_\-]+')
+
+def serialize_error(code: str, message: str) -> str:
+    """Serialize a fixed error body"""
+    return orjson.dumps({
+        "status": "error",
+        "error": {
+            "code": code,
+            "message": message
+        }
+    }).decode('utf-8')
+
+# Error bodies both handlers send unchanged, serialized once at import
+ERR_INVALID_JSON = serialize_error("INVALID_REQUEST", "Invalid JSON in request body")
+ERR_ENDPOINT_NOT_FOUND = serialize_error("NOT_FOUND", "Endpoint not found")
+ERR_INVALID_USER_ID = serialize_error("INVALID_REQUEST", "user_id cannot contain '/' or be '.' or '..'")
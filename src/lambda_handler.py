@@ -1,121 +1,186 @@
 import json
-import boto3
+import orjson
 import os
+import re
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
+
+from api_responses import (
+    ERR_ENDPOINT_NOT_FOUND, ERR_INVALID_JSON, ERR_INVALID_USER_ID, NAME_RE, serialize_error
+)
+from storage import (
+    EXECUTOR, IS_SAM_LOCAL, WriteConflictError, is_valid_user_id, list_user_ids_from_s3,
+    read_json_from_local, read_json_from_s3, user_document_key, write_json_to_local,
+    write_json_to_s3
+)
 
 # Configuration from environment variables
-S3_BUCKET_NAME = os.environ.get('S3_BUCKET_NAME', 'agent-permissions-data')
-S3_FILE_KEY = os.environ.get('S3_FILE_KEY', 'permissions.json')
+S3_PERMISSIONS_PREFIX = os.environ.get('S3_PERMISSIONS_PREFIX', 'permissions/')
 ENVIRONMENT = os.environ.get('ENVIRONMENT', 'dev')
 LOCAL_FILE_PATH = '/tmp/permissions.json'
 
-# Check if running in SAM Local or AWS Lambda
-IS_SAM_LOCAL = os.environ.get('AWS_SAM_LOCAL') == 'true'
-
 def read_permissions_from_local() -> Dict[str, Any]:
     """Read permissions from local file (for SAM Local)"""
     try:
-        if os.path.exists(LOCAL_FILE_PATH):
-            with open(LOCAL_FILE_PATH, 'r') as f:
-                return json.load(f)
+        data = read_json_from_local(LOCAL_FILE_PATH)
+        if data is not None:
+            return data
         else:
             # Create default permissions with empty agent arrays
+            now_iso = datetime.now().isoformat()
             default_data = {
-                "last_updated": datetime.now().isoformat(),
+                "last_updated": now_iso,
                 "permissions": {
                     "user_123": [],
                     "user_456": [],
                     "user_789": []
                 }
             }
-            write_permissions_to_local(default_data)
+            write_permissions_to_local(default_data, now_iso)
             return default_data
     except Exception as e:
         raise Exception(f"Unable to retrieve local permissions: {str(e)}")
 
-def write_permissions_to_local(data: Dict[str, Any]) -> None:
+def write_permissions_to_local(data: Dict[str, Any], now_iso: Optional[str] = None) -> None:
     """Write permissions to local file (for SAM Local)"""
     try:
-        data["last_updated"] = datetime.now().isoformat()
-        with open(LOCAL_FILE_PATH, 'w') as f:
-            json.dump(data, f, indent=2)
+        data["last_updated"] = now_iso or datetime.now().isoformat()
+        write_json_to_local(LOCAL_FILE_PATH, data)
     except Exception as e:
         raise Exception(f"Unable to update local permissions: {str(e)}")
 
-def read_permissions_from_s3() -> Dict[str, Any]:
-    """Read permissions from S3 bucket"""
-    # Initialize S3 client only when needed (for AWS)
-    s3_client = boto3.client('s3')
+def permissions_key(user_id: str) -> str:
+    """S3 key of the document holding one user's permitted agents"""
+    return user_document_key(S3_PERMISSIONS_PREFIX, user_id)
 
+def read_user_permissions_from_s3(user_id: str) -> Tuple[Optional[List[str]], Optional[str]]:
+    """Read one user's permitted agents and their ETag from S3 (None if the user doesn't exist)"""
     try:
-        response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=S3_FILE_KEY)
-        content = response['Body'].read().decode('utf-8')
-        return json.loads(content)
-    except s3_client.exceptions.NoSuchKey:
-        # Create empty permissions file if it doesn't exist
-        default_data = {
-            "last_updated": datetime.now().isoformat(),
-            "permissions": {}
-        }
-        write_permissions_to_s3(default_data)
-        return default_data
+        data, etag = read_json_from_s3(permissions_key(user_id))
+        return (data["permitted_agents"] if data is not None else None), etag
     except Exception as e:
         raise Exception(f"Unable to retrieve permissions: {str(e)}")
 
-def write_permissions_to_s3(data: Dict[str, Any]) -> None:
-    """Write permissions to S3 bucket"""
-    # Initialize S3 client only when needed (for AWS)
-    s3_client = boto3.client('s3')
+def read_all_permissions_from_s3() -> Dict[str, Tuple[List[str], Optional[str]]]:
+    """Read every user's permitted agents and their ETags from S3"""
+    try:
+        user_ids = list_user_ids_from_s3(S3_PERMISSIONS_PREFIX)
+        documents = EXECUTOR.map(lambda user_id: read_json_from_s3(permissions_key(user_id)), user_ids)
+
+        permissions = {}
+        for user_id, (data, etag) in zip(user_ids, documents):
+            # Skip users deleted between the listing and the read
+            if data is not None:
+                permissions[user_id] = (data["permitted_agents"], etag)
+        return permissions
+    except Exception as e:
+        raise Exception(f"Unable to retrieve permissions: {str(e)}")
 
+def write_user_permissions_to_s3(user_id: str, agents: List[str], etag: Optional[str] = None,
+                                 now_iso: Optional[str] = None) -> str:
+    """Write one user's permitted agents to S3, failing if they changed since they were read"""
+    data = {
+        "user_id": user_id,
+        "permitted_agents": agents,
+        "last_updated": now_iso or datetime.now().isoformat()
+    }
     try:
-        data["last_updated"] = datetime.now().isoformat()
-        content = json.dumps(data, indent=2)
-        s3_client.put_object(
-            Bucket=S3_BUCKET_NAME,
-            Key=S3_FILE_KEY,
-            Body=content,
-            ContentType='application/json'
-        )
+        return write_json_to_s3(permissions_key(user_id), data, etag)
+    except WriteConflictError:
+        raise
     except Exception as e:
         raise Exception(f"Unable to update permissions: {str(e)}")
 
+def write_users_permissions_to_s3(updates: Dict[str, Tuple[List[str], Optional[str]]],
+                                  now_iso: Optional[str] = None) -> List[str]:
+    """Write several users' permitted agents to S3 concurrently, returning the user IDs that failed"""
+    def write(item: Tuple[str, Tuple[List[str], Optional[str]]]) -> Optional[str]:
+        user_id, (agents, etag) = item
+        try:
+            write_user_permissions_to_s3(user_id, agents, etag, now_iso)
+            return None
+        except Exception:
+            return user_id
+
+    return [user_id for user_id in EXECUTOR.map(write, updates.items()) if user_id is not None]
+
 # Environment-aware functions
-def read_permissions() -> Dict[str, Any]:
-    """Read permissions - auto-detects environment"""
+def read_user_permissions(user_id: str) -> Tuple[Optional[List[str]], Optional[str]]:
+    """Read one user's permitted agents and ETag (None locally) - auto-detects environment"""
     if IS_SAM_LOCAL:
-        return read_permissions_from_local()
+        return read_permissions_from_local()["permissions"].get(user_id), None
     else:
-        return read_permissions_from_s3()
+        return read_user_permissions_from_s3(user_id)
 
-def write_permissions(data: Dict[str, Any]) -> None:
-    """Write permissions - auto-detects environment"""
+def read_all_permissions() -> Dict[str, Tuple[List[str], Optional[str]]]:
+    """Read every user's permitted agents and ETag (None locally) - auto-detects environment"""
     if IS_SAM_LOCAL:
-        write_permissions_to_local(data)
+        return {user_id: (agents, None) for user_id, agents in read_permissions_from_local()["permissions"].items()}
     else:
-        write_permissions_to_s3(data)
+        return read_all_permissions_from_s3()
+
+def write_user_permissions(user_id: str, agents: List[str], etag: Optional[str] = None,
+                           now_iso: Optional[str] = None) -> None:
+    """Write one user's permitted agents read with the given ETag - auto-detects environment"""
+    if IS_SAM_LOCAL:
+        data = read_permissions_from_local()
+        data["permissions"][user_id] = agents
+        write_permissions_to_local(data, now_iso)
+    else:
+        write_user_permissions_to_s3(user_id, agents, etag, now_iso)
+
+def write_users_permissions(updates: Dict[str, Tuple[List[str], Optional[str]]],
+                            now_iso: Optional[str] = None) -> List[str]:
+    """Write several users' permitted agents, returning the user IDs that failed - auto-detects environment"""
+    if IS_SAM_LOCAL:
+        # Apply every update to one copy of the file and write it once
+        data = read_permissions_from_local()
+        for user_id, (agents, _) in updates.items():
+            data["permissions"][user_id] = agents
+        write_permissions_to_local(data, now_iso)
+        return []
+    else:
+        return write_users_permissions_to_s3(updates, now_iso)
+
+# Response headers are identical for every response; shared, never mutated
+_HEADERS = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET,POST,OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token'
+}
 
 def create_response(status_code: int, body: dict) -> dict:
     """Create proper API Gateway response"""
     return {
         'statusCode': status_code,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'GET,POST,OPTIONS',
-            'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token'
-        },
-        'body': json.dumps(body)
+        'headers': _HEADERS,
+        'body': orjson.dumps(body).decode('utf-8')
+    }
+
+def create_serialized_response(status_code: int, body: str) -> dict:
+    """Create API Gateway response from an already serialized body"""
+    return {
+        'statusCode': status_code,
+        'headers': _HEADERS,
+        'body': body
     }
 
+# Error bodies that never vary, serialized once at import
+_ERR_RETRIEVE_PERMISSIONS = serialize_error("SERVICE_UNAVAILABLE", "Unable to retrieve permissions at this time")
+_ERR_AGENT_NAME_REQUIRED = serialize_error("INVALID_REQUEST", "agent_name is required")
+_ERR_UPDATE_PERMISSIONS = serialize_error("SERVICE_UNAVAILABLE", "Unable to update permissions at this time")
+_ERR_USER_ID_REQUIRED = serialize_error("INVALID_REQUEST", "user_id is required")
+_ERR_CREATE_USER = serialize_error("SERVICE_UNAVAILABLE", "Unable to create user at this time")
+_ERR_CLEAR_PERMISSIONS = serialize_error("SERVICE_UNAVAILABLE", "Unable to clear permissions at this time")
+_ERR_CONCURRENT_UPDATE = serialize_error("CONCURRENT_UPDATE", "Permissions were changed by another request, please retry")
+
 def handle_user_exists(user_id: str) -> dict:
     """Handle GET /users/{user_id}"""
     try:
-        # Normalize user_id to lowercase
-        user_id = user_id.lower()
-        data = read_permissions()
+        agents, _ = read_user_permissions(user_id)
 
-        if user_id not in data["permissions"]:
+        if agents is None:
             return create_response(404, {
                 "status": "error",
                 "error": {
@@ -125,6 +190,14 @@ def handle_user_exists(user_id: str) -> dict:
                 }
             })
 
+        # Fixed shape with one variable: when the user_id needs no JSON
+        # escaping, fill the template and skip the encoder
+        if NAME_RE.fullmatch(user_id):
+            return create_serialized_response(200, (
+                f'{{"status":"success","data":{{"user_id":"{user_id}","exists":true}},'
+                f'"message":"User exists in the system"}}'
+            ))
+
         return create_response(200, {
             "status": "success",
             "data": {
@@ -135,22 +208,14 @@ def handle_user_exists(user_id: str) -> dict:
         })
 
     except Exception as e:
-        return create_response(500, {
-            "status": "error",
-            "error": {
-                "code": "SERVICE_UNAVAILABLE",
-                "message": "Unable to retrieve permissions at this time"
-            }
-        })
+        return create_serialized_response(500, _ERR_RETRIEVE_PERMISSIONS)
 
 def handle_get_permissions(user_id: str) -> dict:
     """Handle GET /permissions/{user_id}"""
     try:
-        # Normalize user_id to lowercase for lookup
-        user_id = user_id.lower()
-        data = read_permissions()
+        agents, _ = read_user_permissions(user_id)
 
-        if user_id not in data["permissions"]:
+        if agents is None:
             return create_response(404, {
                 "status": "error",
                 "error": {
@@ -164,20 +229,14 @@ def handle_get_permissions(user_id: str) -> dict:
             "status": "success",
             "data": {
                 "user_id": user_id,
-                "permitted_agents": data["permissions"][user_id]
+                "permitted_agents": agents
             }
         })
 
     except Exception as e:
-        return create_response(500, {
-            "status": "error",
-            "error": {
-                "code": "SERVICE_UNAVAILABLE",
-                "message": "Unable to retrieve permissions at this time"
-            }
-        })
+        return create_serialized_response(500, _ERR_RETRIEVE_PERMISSIONS)
 
-def handle_add_permission(user_id: str, body: str) -> dict:
+def handle_add_permission(user_id: str, body: str, retry: bool = True) -> dict:
     """Handle POST /permissions/{user_id}/agents"""
     try:
         # Parse request body
@@ -185,74 +244,62 @@ def handle_add_permission(user_id: str, body: str) -> dict:
         agent_name = request_data.get('agent_name')
 
         if not agent_name:
-            return create_response(400, {
-                "status": "error",
-                "error": {
-                    "code": "INVALID_REQUEST",
-                    "message": "agent_name is required"
-                }
-            })
+            return create_serialized_response(400, _ERR_AGENT_NAME_REQUIRED)
 
-        # Normalize user_id to lowercase for lookup and storage
-        user_id = user_id.lower()
-        data = read_permissions()
+        agents, etag = read_user_permissions(user_id)
 
         # Check if user exists
-        if user_id in data["permissions"]:
-            # User exists - check if agent already permitted
-            if agent_name in data["permissions"][user_id]:
+        if agents is not None:
+            # User exists - check if agent already permitted. An insertion-ordered
+            # set gives constant-time lookups and drops any duplicate entries
+            existing = dict.fromkeys(agents)
+            if agent_name in existing:
                 return create_response(200, {
                     "status": "success",
                     "data": {
                         "user_id": user_id,
                         "agent_added": agent_name,
-                        "permitted_agents": data["permissions"][user_id]
+                        "permitted_agents": agents
                     },
                     "message": "Permission already exists"
                 })
             else:
                 # Add agent to existing user
-                data["permissions"][user_id].append(agent_name)
-                write_permissions(data)
+                existing[agent_name] = None
+                agents = list(existing)
+                write_user_permissions(user_id, agents, etag)
                 return create_response(200, {
                     "status": "success",
                     "data": {
                         "user_id": user_id,
                         "agent_added": agent_name,
-                        "permitted_agents": data["permissions"][user_id]
+                        "permitted_agents": agents
                     },
                     "message": "Permission added successfully"
                 })
         else:
             # User doesn't exist - create new user with agent permission
-            data["permissions"][user_id] = [agent_name]
-            write_permissions(data)
+            agents = [agent_name]
+            write_user_permissions(user_id, agents)
             return create_response(200, {
                 "status": "success",
                 "data": {
                     "user_id": user_id,
                     "agent_added": agent_name,
-                    "permitted_agents": data["permissions"][user_id]
+                    "permitted_agents": agents
                 },
                 "message": "User created and permission added successfully"
             })
 
     except json.JSONDecodeError:
-        return create_response(400, {
-            "status": "error",
-            "error": {
-                "code": "INVALID_REQUEST",
-                "message": "Invalid JSON in request body"
-            }
-        })
+        return create_serialized_response(400, ERR_INVALID_JSON)
+    except WriteConflictError:
+        # Another request changed the user between our read and write; redo it once
+        if retry:
+            return handle_add_permission(user_id, body, retry=False)
+        return create_serialized_response(409, _ERR_CONCURRENT_UPDATE)
     except Exception as e:
-        return create_response(500, {
-            "status": "error",
-            "error": {
-                "code": "SERVICE_UNAVAILABLE",
-                "message": "Unable to update permissions at this time"
-            }
-        })
+        return create_serialized_response(500, _ERR_UPDATE_PERMISSIONS)
 
 def handle_create_user(body: str) -> dict:
     """Handle POST /users"""
@@ -262,20 +309,17 @@ def handle_create_user(body: str) -> dict:
         user_id = request_data.get('user_id')
 
         if not user_id:
-            return create_response(400, {
-                "status": "error",
-                "error": {
-                    "code": "INVALID_REQUEST",
-                    "message": "user_id is required"
-                }
-            })
+            return create_serialized_response(400, _ERR_USER_ID_REQUIRED)
+
+        if not isinstance(user_id, str) or not is_valid_user_id(user_id):
+            return create_serialized_response(400, ERR_INVALID_USER_ID)
 
         # Store user_id as lowercase in JSON
         user_id_lower = user_id.lower()
-        data = read_permissions()
+        agents, _ = read_user_permissions(user_id_lower)
 
         # Check if user already exists
-        if user_id_lower in data["permissions"]:
+        if agents is not None:
             return create_response(409, {
                 "status": "error",
                 "error": {
@@ -286,44 +330,40 @@ def handle_create_user(body: str) -> dict:
             })
 
         # Create new user with empty permissions
-        data["permissions"][user_id_lower] = []
-        write_permissions(data)
+        now_iso = datetime.now().isoformat()
+        write_user_permissions(user_id_lower, [], now_iso=now_iso)
 
         return create_response(201, {
             "status": "success",
             "data": {
                 "user_id": user_id_lower,
                 "permitted_agents": [],
-                "created_at": datetime.now().isoformat()
+                "created_at": now_iso
             },
             "message": "User created successfully"
         })
 
     except json.JSONDecodeError:
-        return create_response(400, {
+        return create_serialized_response(400, ERR_INVALID_JSON)
+    except WriteConflictError:
+        # Another request created the user between our read and write
+        return create_response(409, {
             "status": "error",
             "error": {
-                "code": "INVALID_REQUEST",
-                "message": "Invalid JSON in request body"
+                "code": "USER_ALREADY_EXISTS",
+                "message": "User already exists in the system",
+                "user_id": user_id_lower
             }
         })
     except Exception as e:
-        return create_response(500, {
-            "status": "error",
-            "error": {
-                "code": "SERVICE_UNAVAILABLE",
-                "message": "Unable to create user at this time"
-            }
-        })
+        return create_serialized_response(500, _ERR_CREATE_USER)
 
-def handle_clear_user_permissions(user_id: str) -> dict:
+def handle_clear_user_permissions(user_id: str, retry: bool = True) -> dict:
     """Handle DELETE /permissions/{user_id}"""
     try:
-        # Normalize user_id to lowercase
-        user_id = user_id.lower()
-        data = read_permissions()
+        agents, etag = read_user_permissions(user_id)
 
-        if user_id not in data["permissions"]:
+        if agents is None:
             return create_response(404, {
                 "status": "error",
                 "error": {
@@ -334,8 +374,7 @@ def handle_clear_user_permissions(user_id: str) -> dict:
             })
 
         # Clear all permissions for the user
-        data["permissions"][user_id] = []
-        write_permissions(data)
+        write_user_permissions(user_id, [], etag)
 
         return create_response(200, {
             "status": "success",
@@ -346,29 +385,28 @@ def handle_clear_user_permissions(user_id: str) -> dict:
             "message": "All permissions cleared for user"
         })
 
+    except WriteConflictError:
+        # Another request changed the user between our read and write; redo it once
+        if retry:
+            return handle_clear_user_permissions(user_id, retry=False)
+        return create_serialized_response(409, _ERR_CONCURRENT_UPDATE)
     except Exception as e:
-        return create_response(500, {
-            "status": "error",
-            "error": {
-                "code": "SERVICE_UNAVAILABLE",
-                "message": "Unable to clear permissions at this time"
-            }
-        })
+        return create_serialized_response(500, _ERR_CLEAR_PERMISSIONS)
 
 def handle_get_all_permissions() -> dict:
     """Handle GET /permissions"""
     try:
-        data = read_permissions()
+        permissions = {user_id: agents for user_id, (agents, _) in read_all_permissions().items()}
 
         # Calculate summary statistics
-        total_users = len(data["permissions"])
-        users_with_permissions = sum(1 for perms in data["permissions"].values() if len(perms) > 0)
-        total_permissions = sum(len(perms) for perms in data["permissions"].values())
+        total_users = len(permissions)
+        users_with_permissions = sum(1 for perms in permissions.values() if len(perms) > 0)
+        total_permissions = sum(len(perms) for perms in permissions.values())
 
         return create_response(200, {
             "status": "success",
             "data": {
-                "permissions": data["permissions"],
+                "permissions": permissions,
                 "summary": {
                     "total_users": total_users,
                     "users_with_permissions": users_with_permissions,
@@ -378,85 +416,83 @@ def handle_get_all_permissions() -> dict:
         })
 
     except Exception as e:
-        return create_response(500, {
-            "status": "error",
-            "error": {
-                "code": "SERVICE_UNAVAILABLE",
-                "message": "Unable to retrieve permissions at this time"
-            }
-        })
+        return create_serialized_response(500, _ERR_RETRIEVE_PERMISSIONS)
 
 def handle_clear_all_permissions() -> dict:
     """Handle DELETE /permissions"""
     try:
-        data = read_permissions()
+        permissions = read_all_permissions()
 
         # Clear all permissions for all users
-        for user_id in data["permissions"]:
-            data["permissions"][user_id] = []
+        now_iso = datetime.now().isoformat()
+        failed = write_users_permissions({user_id: ([], etag) for user_id, (_, etag) in permissions.items()}, now_iso)
 
-        write_permissions(data)
+        if failed:
+            failed_set = set(failed)
+            return create_response(500, {
+                "status": "error",
+                "error": {
+                    "code": "PARTIAL_FAILURE",
+                    "message": "Permissions could not be cleared for some users",
+                    "users_cleared": [user_id for user_id in permissions if user_id not in failed_set],
+                    "users_failed": failed
+                }
+            })
 
         return create_response(200, {
             "status": "success",
             "data": {
-                "users_affected": len(data["permissions"]),
-                "users": list(data["permissions"].keys())
+                "users_affected": len(permissions),
+                "users": list(permissions.keys())
             },
             "message": "All permissions cleared for all users"
         })
 
     except Exception as e:
-        return create_response(500, {
-            "status": "error",
-            "error": {
-                "code": "SERVICE_UNAVAILABLE",
-                "message": "Unable to clear permissions at this time"
-            }
-        })
+        return create_serialized_response(500, _ERR_CLEAR_PERMISSIONS)
+
+# Path shape: /{resource}[/{user_id}[/agents]]
+_ROUTE_RE = re.compile(r'^/(users|permissions)(?:/([^/]+)(?:/(agents))?)?$')
+
+# Route table keyed by (method, resource, has user_id segment, has /agents suffix)
+_ROUTES = {
+    ('GET', 'users', True, False): lambda user_id, event: handle_user_exists(user_id),
+    ('POST', 'users', False, False): lambda user_id, event: handle_create_user(event.get('body', '{}')),
+    ('GET', 'permissions', True, False): lambda user_id, event: handle_get_permissions(user_id),
+    ('POST', 'permissions', True, True): lambda user_id, event: handle_add_permission(user_id, event.get('body', '{}')),
+    ('GET', 'permissions', False, False): lambda user_id, event: handle_get_all_permissions(),
+    ('DELETE', 'permissions', True, False): lambda user_id, event: handle_clear_user_permissions(user_id),
+    ('DELETE', 'permissions', False, False): lambda user_id, event: handle_clear_all_permissions(),
+}
 
 def handler(event, context):
     """Main Lambda handler"""
 
     # Handle CORS preflight requests
-    if event.get('httpMethod') == 'OPTIONS':
+    method = event.get('httpMethod', '')
+    if method == 'OPTIONS':
         return create_response(200, {"message": "CORS preflight"})
 
-    # Extract path and method
-    path = event.get('path', '')
-    method = event.get('httpMethod', '').upper()
-    path_parameters = event.get('pathParameters') or {}
-    user_id = path_parameters.get('user_id')
+    # Match the path shape once
+    match = _ROUTE_RE.match(event.get('path', ''))
 
     # Route requests
-    if method == 'GET' and path.startswith('/users/'):
-        return handle_user_exists(user_id)
-
-    elif method == 'POST' and path == '/users':
-        body = event.get('body', '{}')
-        return handle_create_user(body)
-
-    elif method == 'GET' and path.startswith('/permissions/'):
-        return handle_get_permissions(user_id)
+    route = None
+    if match:
+        resource, path_user_id, agents = match.groups()
+        route = _ROUTES.get((method, resource, path_user_id is not None, agents is not None))
 
-    elif method == 'POST' and path.startswith('/permissions/') and path.endswith('/agents'):
-        body = event.get('body', '{}')
-        return handle_add_permission(user_id, body)
+    if route is None:
+        return create_serialized_response(404, ERR_ENDPOINT_NOT_FOUND)
 
-    elif method == 'GET' and path == '/permissions':
-        return handle_get_all_permissions()
-
-    elif method == 'DELETE' and path.startswith('/permissions/') and user_id:
-        return handle_clear_user_permissions(user_id)
+    # Prefer the gateway's path parameter, falling back to the matched path
+    # segment when an event arrives without pathParameters; user_id is
+    # normalized to lowercase here so handlers can use it as-is
+    path_parameters = event.get('pathParameters') or {}
+    user_id = (path_parameters.get('user_id') or path_user_id or '').lower()
 
-    elif method == 'DELETE' and path == '/permissions':
-        return handle_clear_all_permissions()
+    # The user_id becomes an S3 key segment; reject anything that could nest keys
+    if path_user_id is not None and not is_valid_user_id(user_id):
+        return create_serialized_response(400, ERR_INVALID_USER_ID)
 
-    else:
-        return create_response(404, {
-            "status": "error",
-            "error": {
-                "code": "NOT_FOUND",
-                "message": "Endpoint not found"
-            }
-        })
\ No newline at end of file
+    return route(user_id, event)
\ No newline at end of file
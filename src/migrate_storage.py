@@ -0,0 +1,141 @@
+"""One-shot migration from the single-file S3 layout to per-user keys.
+
+Earlier releases stored every user's permissions in permissions.json and every
+profile in user_profiles.json. The handlers now read permissions/<user_id>.json
+and profiles/<user_id>.json, so run this against the bucket right after
+deploying (deploy.sh does):
+
+    S3_BUCKET_NAME=<bucket> python src/migrate_storage.py
+
+Users may already have per-user documents by then, written by the new handlers
+before the migration ran. Legacy data is merged into those instead of being
+skipped: agents are added to the user's permitted_agents, and profile fields
+the new document lacks are filled in from the legacy profile. User IDs are
+lowercased, as the handlers look them up.
+
+Once every user in a legacy file has been migrated, the file is renamed to
+<key>.migrated so later runs are a no-op and cannot re-add agents that were
+cleared since. A file containing invalid user IDs is left in place.
+"""
+import os
+import sys
+from datetime import datetime
+from typing import Any, Callable, Dict, List
+
+from storage import (
+    EXECUTOR, S3_BUCKET_NAME, WriteConflictError, delete_json_from_s3, get_s3,
+    is_valid_user_id, read_json_from_s3, write_json_to_s3
+)
+from lambda_handler import permissions_key
+from profile_handler import profile_key
+
+# Legacy single-file keys (the former S3_FILE_KEY and S3_PROFILES_FILE_KEY settings)
+LEGACY_PERMISSIONS_KEY = os.environ.get('S3_FILE_KEY', 'permissions.json')
+LEGACY_PROFILES_KEY = os.environ.get('S3_PROFILES_FILE_KEY', 'user_profiles.json')
+
+# Attempts at merging into a per-user document that keeps changing underneath us
+MERGE_ATTEMPTS = 5
+
+def _merge_into(key: str, document: Dict[str, Any],
+                merge: Callable[[Dict[str, Any], Dict[str, Any]], Dict[str, Any]]) -> str:
+    """Create key from document, or merge document into the one already there"""
+    for _ in range(MERGE_ATTEMPTS):
+        existing, etag = read_json_from_s3(key)
+        if existing is None:
+            merged = document
+        else:
+            merged = merge(existing, document)
+            if merged == existing:
+                return "unchanged"
+        try:
+            write_json_to_s3(key, merged, etag)
+            return "created" if existing is None else "merged"
+        except WriteConflictError:
+            # Written by a handler since our read; merge into the new version
+            continue
+    raise WriteConflictError(f"{key} kept changing during the migration")
+
+def _archive(legacy_key: str) -> None:
+    """Rename a migrated legacy file so the migration doesn't run again"""
+    get_s3().copy_object(Bucket=S3_BUCKET_NAME, Key=f"{legacy_key}.migrated",
+                         CopySource={'Bucket': S3_BUCKET_NAME, 'Key': legacy_key})
+    delete_json_from_s3(legacy_key)
+
+def _migrate(legacy_key: str, section: str, document_key: Callable[[str], str],
+             combine: Callable[[Any, Any], Any],
+             build: Callable[[str, Any, Dict[str, Any]], Dict[str, Any]],
+             merge: Callable[[Dict[str, Any], Dict[str, Any]], Dict[str, Any]]) -> Dict[str, List[str]]:
+    """Split one legacy file into per-user documents, reporting what happened to each user"""
+    legacy, _ = read_json_from_s3(legacy_key)
+    result = {"created": [], "merged": [], "unchanged": [], "invalid": []}
+    if legacy is None:
+        return result
+
+    # Users whose IDs differ only in case are the same user to the handlers
+    entries: Dict[str, Any] = {}
+    for user_id, entry in legacy.get(section, {}).items():
+        if not is_valid_user_id(user_id):
+            result["invalid"].append(user_id)
+            continue
+        user_id = user_id.lower()
+        entries[user_id] = combine(entries[user_id], entry) if user_id in entries else entry
+
+    def copy(user_id: str) -> str:
+        return _merge_into(document_key(user_id), build(user_id, entries[user_id], legacy), merge)
+
+    for user_id, outcome in zip(entries, EXECUTOR.map(copy, entries)):
+        result[outcome].append(user_id)
+
+    if not result["invalid"]:
+        _archive(legacy_key)
+    return result
+
+def _union(agents: List[str], more: List[str]) -> List[str]:
+    """Agents from both lists, in order, without duplicates"""
+    return list(dict.fromkeys(agents + more))
+
+def _build_permissions(user_id: str, agents: List[str], legacy: Dict[str, Any]) -> Dict[str, Any]:
+    """Per-user permissions document for a legacy entry"""
+    return {
+        "user_id": user_id,
+        "permitted_agents": agents,
+        "last_updated": legacy.get("last_updated")
+    }
+
+def _merge_permissions(existing: Dict[str, Any], document: Dict[str, Any]) -> Dict[str, Any]:
+    """Add the legacy agents a per-user permissions document doesn't have yet"""
+    agents = _union(existing["permitted_agents"], document["permitted_agents"])
+    if agents == existing["permitted_agents"]:
+        return existing
+    return {**existing, "permitted_agents": agents, "last_updated": datetime.now().isoformat()}
+
+def migrate_permissions() -> Dict[str, List[str]]:
+    """Merge each user's agents from the legacy permissions file into permissions/<user_id>.json"""
+    return _migrate(LEGACY_PERMISSIONS_KEY, "permissions", permissions_key,
+                    _union, _build_permissions, _merge_permissions)
+
+def migrate_profiles() -> Dict[str, List[str]]:
+    """Merge each profile from the legacy profiles file into profiles/<user_id>.json"""
+    return _migrate(
+        LEGACY_PROFILES_KEY, "profiles", profile_key,
+        # Of two legacy profiles for one user, the first one listed wins
+        lambda profile, other: {**other, **profile},
+        lambda user_id, profile, legacy: profile,
+        # Fields already in the per-user profile are newer than the legacy ones
+        lambda existing, profile: {**profile, **existing}
+    )
+
+def main() -> int:
+    """Run both migrations and print a summary; exit non-zero if any user was skipped as invalid"""
+    invalid = False
+    for name, migrate in (("permissions", migrate_permissions), ("profiles", migrate_profiles)):
+        result = migrate()
+        print(f"{name}: {len(result['created'])} created, {len(result['merged'])} merged, "
+              f"{len(result['unchanged'])} unchanged, {len(result['invalid'])} invalid")
+        for user_id in result["invalid"]:
+            print(f"  skipped invalid user_id: {user_id!r}")
+        invalid = invalid or bool(result["invalid"])
+    return 1 if invalid else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
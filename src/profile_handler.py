@@ -1,134 +1,176 @@
 import json
-import boto3
+import orjson
 import os
-import random
+import re
 from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
+
+from api_responses import (
+    ERR_ENDPOINT_NOT_FOUND, ERR_INVALID_JSON, ERR_INVALID_USER_ID, NAME_RE, serialize_error
+)
+from storage import (
+    EXECUTOR, IS_SAM_LOCAL, WriteConflictError, delete_json_from_s3, is_valid_user_id,
+    list_user_ids_from_s3, read_json_from_local, read_json_from_s3, user_document_key,
+    write_json_to_local, write_json_to_s3
+)
 
 # Configuration from environment variables
-S3_BUCKET_NAME = os.environ.get('S3_BUCKET_NAME', 'agent-permissions-data')
-S3_PROFILES_FILE_KEY = os.environ.get('S3_PROFILES_FILE_KEY', 'user_profiles.json')
+S3_PROFILES_PREFIX = os.environ.get('S3_PROFILES_PREFIX', 'profiles/')
 ENVIRONMENT = os.environ.get('ENVIRONMENT', 'dev')
 LOCAL_PROFILES_FILE_PATH = '/tmp/user_profiles.json'
 
-# Check if running in SAM Local or AWS Lambda
-IS_SAM_LOCAL = os.environ.get('AWS_SAM_LOCAL') == 'true'
-
-# Funny superhero last names
-SUPERHERO_LAST_NAMES = [
-    "Thunderbolt", "Stormwind", "Fireburst", "Shadowbane", "Lightspeed",
-    "Iceheart", "Starfist", "Nightwing", "Ironclad", "Blazefire",
-    "Frostbite", "Quickstrike", "Darkblade", "Goldeneye", "Silverwing",
-    "Thunderstorm", "Flameheart", "Crystalclaw", "Moonbeam", "Sunburst",
-    "Steelstorm", "Crimsonbolt", "Emeraldfire", "Diamondshield", "Rubystrike",
-    "Sapphirewing", "Platinumfist", "Titanforge", "Voidwalker", "Starstrike"
-]
-
 def read_profiles_from_local() -> Dict[str, Any]:
     """Read user profiles from local file (for SAM Local)"""
     try:
-        if os.path.exists(LOCAL_PROFILES_FILE_PATH):
-            with open(LOCAL_PROFILES_FILE_PATH, 'r') as f:
-                return json.load(f)
+        data = read_json_from_local(LOCAL_PROFILES_FILE_PATH)
+        if data is not None:
+            return data
         else:
             # Create default profiles structure
+            now_iso = datetime.now().isoformat()
             default_data = {
-                "last_updated": datetime.now().isoformat(),
+                "last_updated": now_iso,
                 "profiles": {}
             }
-            write_profiles_to_local(default_data)
+            write_profiles_to_local(default_data, now_iso)
             return default_data
     except Exception as e:
         raise Exception(f"Unable to retrieve local profiles: {str(e)}")
 
-def write_profiles_to_local(data: Dict[str, Any]) -> None:
+def write_profiles_to_local(data: Dict[str, Any], now_iso: Optional[str] = None) -> None:
     """Write user profiles to local file (for SAM Local)"""
     try:
-        data["last_updated"] = datetime.now().isoformat()
-        with open(LOCAL_PROFILES_FILE_PATH, 'w') as f:
-            json.dump(data, f, indent=2)
+        data["last_updated"] = now_iso or datetime.now().isoformat()
+        write_json_to_local(LOCAL_PROFILES_FILE_PATH, data)
     except Exception as e:
         raise Exception(f"Unable to update local profiles: {str(e)}")
 
-def read_profiles_from_s3() -> Dict[str, Any]:
-    """Read user profiles from S3 bucket"""
-    s3_client = boto3.client('s3')
+def profile_key(user_id: str) -> str:
+    """S3 key of the document holding one user's profile"""
+    return user_document_key(S3_PROFILES_PREFIX, user_id)
 
+def read_profile_from_s3(user_id: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """Read one user's profile and its ETag from S3 (None if it doesn't exist)"""
     try:
-        response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=S3_PROFILES_FILE_KEY)
-        content = response['Body'].read().decode('utf-8')
-        return json.loads(content)
-    except s3_client.exceptions.NoSuchKey:
-        # Create empty profiles file if it doesn't exist
-        default_data = {
-            "last_updated": datetime.now().isoformat(),
-            "profiles": {}
-        }
-        write_profiles_to_s3(default_data)
-        return default_data
+        return read_json_from_s3(profile_key(user_id))
+    except Exception as e:
+        raise Exception(f"Unable to retrieve profile: {str(e)}")
+
+def read_all_profiles_from_s3() -> Dict[str, Dict[str, Any]]:
+    """Read every user's profile from S3"""
+    try:
+        user_ids = list_user_ids_from_s3(S3_PROFILES_PREFIX)
+        documents = EXECUTOR.map(lambda user_id: read_json_from_s3(profile_key(user_id)), user_ids)
+
+        profiles = {}
+        for user_id, (profile, _) in zip(user_ids, documents):
+            # Skip profiles deleted between the listing and the read
+            if profile is not None:
+                profiles[user_id] = profile
+        return profiles
     except Exception as e:
         raise Exception(f"Unable to retrieve profiles: {str(e)}")
 
-def write_profiles_to_s3(data: Dict[str, Any]) -> None:
-    """Write user profiles to S3 bucket"""
-    s3_client = boto3.client('s3')
+def write_profile_to_s3(user_id: str, profile: Dict[str, Any], etag: Optional[str] = None) -> str:
+    """Write one user's profile to S3, failing if it changed since it was read"""
+    try:
+        return write_json_to_s3(profile_key(user_id), profile, etag)
+    except WriteConflictError:
+        raise
+    except Exception as e:
+        raise Exception(f"Unable to update profile: {str(e)}")
 
+def delete_profile_from_s3(user_id: str) -> None:
+    """Delete one user's profile from S3"""
     try:
-        data["last_updated"] = datetime.now().isoformat()
-        content = json.dumps(data, indent=2)
-        s3_client.put_object(
-            Bucket=S3_BUCKET_NAME,
-            Key=S3_PROFILES_FILE_KEY,
-            Body=content,
-            ContentType='application/json'
-        )
+        delete_json_from_s3(profile_key(user_id))
     except Exception as e:
-        raise Exception(f"Unable to update profiles: {str(e)}")
+        raise Exception(f"Unable to delete profile: {str(e)}")
 
 # Environment-aware functions
-def read_profiles() -> Dict[str, Any]:
-    """Read profiles - auto-detects environment"""
+def read_profile(user_id: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """Read one user's profile and ETag (None locally) - auto-detects environment"""
+    if IS_SAM_LOCAL:
+        return read_profiles_from_local()["profiles"].get(user_id), None
+    else:
+        return read_profile_from_s3(user_id)
+
+def read_all_profiles() -> Dict[str, Dict[str, Any]]:
+    """Read every user's profile - auto-detects environment"""
+    if IS_SAM_LOCAL:
+        return read_profiles_from_local()["profiles"]
+    else:
+        return read_all_profiles_from_s3()
+
+def write_profile(user_id: str, profile: Dict[str, Any], etag: Optional[str] = None) -> None:
+    """Write one user's profile read with the given ETag - auto-detects environment"""
     if IS_SAM_LOCAL:
-        return read_profiles_from_local()
+        data = read_profiles_from_local()
+        data["profiles"][user_id] = profile
+        write_profiles_to_local(data, profile.get("updated_at"))
     else:
-        return read_profiles_from_s3()
+        write_profile_to_s3(user_id, profile, etag)
 
-def write_profiles(data: Dict[str, Any]) -> None:
-    """Write profiles - auto-detects environment"""
+def delete_profile(user_id: str) -> None:
+    """Delete one user's profile - auto-detects environment"""
     if IS_SAM_LOCAL:
+        data = read_profiles_from_local()
+        data["profiles"].pop(user_id, None)
         write_profiles_to_local(data)
     else:
-        write_profiles_to_s3(data)
+        delete_profile_from_s3(user_id)
+
+# Response headers are identical for every response; shared, never mutated
+_HEADERS = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET,POST,PUT,DELETE,OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token'
+}
 
 def create_response(status_code: int, body: dict) -> dict:
     """Create proper API Gateway response"""
     return {
         'statusCode': status_code,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'GET,POST,PUT,DELETE,OPTIONS',
-            'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token'
-        },
-        'body': json.dumps(body)
+        'headers': _HEADERS,
+        'body': orjson.dumps(body).decode('utf-8')
     }
 
+def create_serialized_response(status_code: int, body: str) -> dict:
+    """Create API Gateway response from an already serialized body"""
+    return {
+        'statusCode': status_code,
+        'headers': _HEADERS,
+        'body': body
+    }
+
+# Error bodies that never vary, serialized once at import
+_ERR_RETRIEVE_PROFILE = serialize_error("SERVICE_UNAVAILABLE", "Unable to retrieve profile at this time")
+_ERR_CREATE_PROFILE = serialize_error("SERVICE_UNAVAILABLE", "Unable to create profile at this time")
+_ERR_UPDATE_PROFILE = serialize_error("SERVICE_UNAVAILABLE", "Unable to update profile at this time")
+_ERR_DELETE_PROFILE = serialize_error("SERVICE_UNAVAILABLE", "Unable to delete profile at this time")
+_ERR_RETRIEVE_PROFILES = serialize_error("SERVICE_UNAVAILABLE", "Unable to retrieve profiles at this time")
+_ERR_CONCURRENT_UPDATE = serialize_error("CONCURRENT_UPDATE", "Profile was changed by another request, please retry")
+
+# Validation patterns, compiled once at import
+_EMAIL_RE = re.compile(r'[^@\s]+@[^@\s]+\.[^@\s]+')
+
 def validate_profile_data(profile_data: Dict[str, Any]) -> Optional[str]:
     """Validate profile data and return error message if invalid"""
     required_fields = ['email', 'first_name', 'last_name']
 
     for field in required_fields:
-        if field not in profile_data or not profile_data[field]:
+        if not profile_data.get(field):
             return f"{field} is required"
 
     # Basic email validation
     email = profile_data.get('email', '')
-    if '@' not in email or '.' not in email.split('@')[-1]:
+    if not _EMAIL_RE.fullmatch(email):
         return "Invalid email format"
 
     # Validate first_name for use as user_id (no spaces, special chars)
     first_name = profile_data.get('first_name', '')
-    if not first_name.replace('_', '').replace('-', '').isalnum():
+    if not NAME_RE.fullmatch(first_name):
         return "first_name can only contain letters, numbers, hyphens, and underscores (will be used as user ID)"
 
     return None
@@ -136,10 +178,9 @@ def validate_profile_data(profile_data: Dict[str, Any]) -> Optional[str]:
 def handle_get_profile(user_id: str) -> dict:
     """Handle GET /profiles/{user_id}"""
     try:
-        user_id = user_id.lower()
-        data = read_profiles()
+        profile, _ = read_profile(user_id)
 
-        if user_id not in data["profiles"]:
+        if profile is None:
             return create_response(404, {
                 "status": "error",
                 "error": {
@@ -153,23 +194,18 @@ def handle_get_profile(user_id: str) -> dict:
             "status": "success",
             "data": {
                 "user_id": user_id,
-                "profile": data["profiles"][user_id]
+                "profile": profile
             }
         })
 
     except Exception as e:
-        return create_response(500, {
-            "status": "error",
-            "error": {
-                "code": "SERVICE_UNAVAILABLE",
-                "message": "Unable to retrieve profile at this time"
-            }
-        })
+        return create_serialized_response(500, _ERR_RETRIEVE_PROFILE)
 
 def handle_create_profile(body: str) -> dict:
     """Handle POST /profiles"""
     try:
         request_data = json.loads(body)
+        now_iso = datetime.now().isoformat()
 
         # Extract profile data first to get first_name
         profile_data = {
@@ -180,8 +216,8 @@ def handle_create_profile(body: str) -> dict:
             "company": request_data.get('company', ''),
             "role": request_data.get('role', ''),
             "bio": request_data.get('bio', ''),
-            "created_at": datetime.now().isoformat(),
-            "updated_at": datetime.now().isoformat()
+            "created_at": now_iso,
+            "updated_at": now_iso
         }
 
         # Validate profile data
@@ -197,10 +233,10 @@ def handle_create_profile(body: str) -> dict:
 
         # Auto-generate user_id from first_name (convert to lowercase)
         user_id = profile_data['first_name'].lower()
-        data = read_profiles()
+        existing_profile, _ = read_profile(user_id)
 
         # Check if profile already exists
-        if user_id in data["profiles"]:
+        if existing_profile is not None:
             return create_response(409, {
                 "status": "error",
                 "error": {
@@ -211,8 +247,7 @@ def handle_create_profile(body: str) -> dict:
             })
 
         # Create new profile
-        data["profiles"][user_id] = profile_data
-        write_profiles(data)
+        write_profile(user_id, profile_data)
 
         return create_response(201, {
             "status": "success",
@@ -224,30 +259,27 @@ def handle_create_profile(body: str) -> dict:
         })
 
     except json.JSONDecodeError:
-        return create_response(400, {
+        return create_serialized_response(400, ERR_INVALID_JSON)
+    except WriteConflictError:
+        # Another request created the profile between our read and write
+        return create_response(409, {
             "status": "error",
             "error": {
-                "code": "INVALID_REQUEST",
-                "message": "Invalid JSON in request body"
+                "code": "PROFILE_ALREADY_EXISTS",
+                "message": "User profile already exists",
+                "user_id": user_id
             }
         })
     except Exception as e:
-        return create_response(500, {
-            "status": "error",
-            "error": {
-                "code": "SERVICE_UNAVAILABLE",
-                "message": "Unable to create profile at this time"
-            }
-        })
+        return create_serialized_response(500, _ERR_CREATE_PROFILE)
 
-def handle_update_profile(user_id: str, body: str) -> dict:
+def handle_update_profile(user_id: str, body: str, retry: bool = True) -> dict:
     """Handle PUT /profiles/{user_id}"""
     try:
         request_data = json.loads(body)
-        user_id = user_id.lower()
-        data = read_profiles()
+        current_profile, etag = read_profile(user_id)
 
-        if user_id not in data["profiles"]:
+        if current_profile is None:
             return create_response(404, {
                 "status": "error",
                 "error": {
@@ -258,7 +290,7 @@ def handle_update_profile(user_id: str, body: str) -> dict:
             })
 
         # Update profile data
-        current_profile = data["profiles"][user_id]
+        now_iso = datetime.now().isoformat()
         updated_profile = {
             "email": request_data.get('email', current_profile.get('email')),
             "first_name": request_data.get('first_name', current_profile.get('first_name')),
@@ -268,7 +300,7 @@ def handle_update_profile(user_id: str, body: str) -> dict:
             "role": request_data.get('role', current_profile.get('role', '')),
             "bio": request_data.get('bio', current_profile.get('bio', '')),
             "created_at": current_profile.get('created_at'),
-            "updated_at": datetime.now().isoformat()
+            "updated_at": now_iso
         }
 
         # Validate updated profile data
@@ -283,8 +315,7 @@ def handle_update_profile(user_id: str, body: str) -> dict:
             })
 
         # Save updated profile
-        data["profiles"][user_id] = updated_profile
-        write_profiles(data)
+        write_profile(user_id, updated_profile, etag)
 
         return create_response(200, {
             "status": "success",
@@ -296,29 +327,21 @@ def handle_update_profile(user_id: str, body: str) -> dict:
         })
 
     except json.JSONDecodeError:
-        return create_response(400, {
-            "status": "error",
-            "error": {
-                "code": "INVALID_REQUEST",
-                "message": "Invalid JSON in request body"
-            }
-        })
+        return create_serialized_response(400, ERR_INVALID_JSON)
+    except WriteConflictError:
+        # Another request changed the profile between our read and write; redo it once
+        if retry:
+            return handle_update_profile(user_id, body, retry=False)
+        return create_serialized_response(409, _ERR_CONCURRENT_UPDATE)
     except Exception as e:
-        return create_response(500, {
-            "status": "error",
-            "error": {
-                "code": "SERVICE_UNAVAILABLE",
-                "message": "Unable to update profile at this time"
-            }
-        })
+        return create_serialized_response(500, _ERR_UPDATE_PROFILE)
 
 def handle_delete_profile(user_id: str) -> dict:
     """Handle DELETE /profiles/{user_id}"""
     try:
-        user_id = user_id.lower()
-        data = read_profiles()
+        profile, _ = read_profile(user_id)
 
-        if user_id not in data["profiles"]:
+        if profile is None:
             return create_response(404, {
                 "status": "error",
                 "error": {
@@ -329,8 +352,7 @@ def handle_delete_profile(user_id: str) -> dict:
             })
 
         # Delete profile
-        del data["profiles"][user_id]
-        write_profiles(data)
+        delete_profile(user_id)
 
         return create_response(200, {
             "status": "success",
@@ -341,22 +363,16 @@ def handle_delete_profile(user_id: str) -> dict:
         })
 
     except Exception as e:
-        return create_response(500, {
-            "status": "error",
-            "error": {
-                "code": "SERVICE_UNAVAILABLE",
-                "message": "Unable to delete profile at this time"
-            }
-        })
+        return create_serialized_response(500, _ERR_DELETE_PROFILE)
 
 def handle_list_profiles() -> dict:
     """Handle GET /profiles - list all profiles"""
     try:
-        data = read_profiles()
+        profiles = read_all_profiles()
 
         # Return list of profiles with basic info only
         profile_list = []
-        for user_id, profile in data["profiles"].items():
+        for user_id, profile in profiles.items():
             profile_list.append({
                 "user_id": user_id,
                 "email": profile.get("email"),
@@ -375,50 +391,46 @@ def handle_list_profiles() -> dict:
         })
 
     except Exception as e:
-        return create_response(500, {
-            "status": "error",
-            "error": {
-                "code": "SERVICE_UNAVAILABLE",
-                "message": "Unable to retrieve profiles at this time"
-            }
-        })
+        return create_serialized_response(500, _ERR_RETRIEVE_PROFILES)
+
+# Path shape: /profiles[/{user_id}]
+_ROUTE_RE = re.compile(r'^/profiles(?:/([^/]+))?$')
+
+# Route table keyed by (method, has user_id segment)
+_ROUTES = {
+    ('GET', False): lambda user_id, event: handle_list_profiles(),
+    ('GET', True): lambda user_id, event: handle_get_profile(user_id),
+    ('POST', False): lambda user_id, event: handle_create_profile(event.get('body', '{}')),
+    ('PUT', True): lambda user_id, event: handle_update_profile(user_id, event.get('body', '{}')),
+    ('DELETE', True): lambda user_id, event: handle_delete_profile(user_id),
+}
 
 def handler(event, context):
     """Main Lambda handler for user profiles"""
 
     # Handle CORS preflight requests
-    if event.get('httpMethod') == 'OPTIONS':
+    method = event.get('httpMethod', '')
+    if method == 'OPTIONS':
         return create_response(200, {"message": "CORS preflight"})
 
-    # Extract path and method
-    path = event.get('path', '')
-    method = event.get('httpMethod', '').upper()
-    path_parameters = event.get('pathParameters') or {}
-    user_id = path_parameters.get('user_id')
+    # Match the path shape once
+    match = _ROUTE_RE.match(event.get('path', ''))
 
     # Route requests
-    if method == 'GET' and path == '/profiles':
-        return handle_list_profiles()
-
-    elif method == 'GET' and path.startswith('/profiles/'):
-        return handle_get_profile(user_id)
+    route = _ROUTES.get((method, match.group(1) is not None)) if match else None
 
-    elif method == 'POST' and path == '/profiles':
-        body = event.get('body', '{}')
-        return handle_create_profile(body)
+    if route is None:
+        return create_serialized_response(404, ERR_ENDPOINT_NOT_FOUND)
 
-    elif method == 'PUT' and path.startswith('/profiles/'):
-        body = event.get('body', '{}')
-        return handle_update_profile(user_id, body)
+    # Prefer the gateway's path parameter, falling back to the matched path
+    # segment when an event arrives without pathParameters; user_id is
+    # normalized to lowercase here so handlers can use it as-is
+    path_user_id = match.group(1)
+    path_parameters = event.get('pathParameters') or {}
+    user_id = (path_parameters.get('user_id') or path_user_id or '').lower()
 
-    elif method == 'DELETE' and path.startswith('/profiles/'):
-        return handle_delete_profile(user_id)
+    # The user_id becomes an S3 key segment; reject anything that could nest keys
+    if path_user_id is not None and not is_valid_user_id(user_id):
+        return create_serialized_response(400, ERR_INVALID_USER_ID)
 
-    else:
-        return create_response(404, {
-            "status": "error",
-            "error": {
-                "code": "NOT_FOUND",
-                "message": "Endpoint not found"
-            }
-        })
\ No newline at end of file
+    return route(user_id, event)
\ No newline at end of file
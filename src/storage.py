@@ -0,0 +1,223 @@
+"""Document storage shared by the Lambda handlers: S3 objects, or local files under SAM Local"""
+import orjson
+import zstandard as zstd
+from botocore.exceptions import ClientError
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+
+# Configuration from environment variables
+S3_BUCKET_NAME = os.environ.get('S3_BUCKET_NAME', 'agent-permissions-data')
+
+# Check if running in SAM Local or AWS Lambda
+IS_SAM_LOCAL = os.environ.get('AWS_SAM_LOCAL') == 'true'
+
+class WriteConflictError(Exception):
+    """A conditional write lost to a concurrent change of the same document"""
+
+# Documents at least this large are stored zstd-compressed; smaller ones gain nothing
+ZSTD_MIN_BYTES = 1024
+
+# Concurrent S3 requests per invocation; the client's connection pool matches it
+S3_MAX_CONCURRENCY = 64
+
+# S3 client shared across warm invocations (created on first use)
+_S3_CLIENT = None
+
+def get_s3():
+    """Return the shared S3 client, creating it on first call (None in SAM Local)"""
+    global _S3_CLIENT
+    if IS_SAM_LOCAL:
+        return None
+    if _S3_CLIENT is None:
+        # Imported here so cold starts that never touch S3 skip loading boto3
+        import boto3
+        from botocore.config import Config
+        _S3_CLIENT = boto3.client('s3', config=Config(
+            max_pool_connections=S3_MAX_CONCURRENCY,
+            tcp_keepalive=True,
+            retries={'mode': 'adaptive'}
+        ))
+    return _S3_CLIENT
+
+# Parsed S3 documents reused across warm invocations: {key: (etag, data, expires_at)}.
+# Entries are revalidated with IfNoneMatch and dropped entirely after the TTL; the
+# least recently used entry is evicted once the cache is full.
+CACHE_TTL_SECONDS = 5
+CACHE_MAX_ENTRIES = 1024
+_CACHE: "OrderedDict[str, Tuple[str, Dict[str, Any], float]]" = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+
+def _cache_get(key: str) -> Optional[Tuple[str, Dict[str, Any], float]]:
+    """Return the cached (etag, data, expires_at) for key if still fresh"""
+    with _CACHE_LOCK:
+        entry = _CACHE.get(key)
+        if entry and entry[2] > time.monotonic():
+            _CACHE.move_to_end(key)
+            return entry
+        _CACHE.pop(key, None)
+        return None
+
+def _cache_put(key: str, etag: str, data: Dict[str, Any]) -> None:
+    """Remember the parsed document stored under key at the given ETag"""
+    with _CACHE_LOCK:
+        _CACHE[key] = (etag, data, time.monotonic() + CACHE_TTL_SECONDS)
+        _CACHE.move_to_end(key)
+        if len(_CACHE) > CACHE_MAX_ENTRIES:
+            _CACHE.popitem(last=False)
+
+def _cache_invalidate(key: str) -> None:
+    """Forget any cached document for key"""
+    with _CACHE_LOCK:
+        _CACHE.pop(key, None)
+
+def _error_code(error: ClientError) -> Optional[str]:
+    """Return the S3 error code carried by a ClientError"""
+    return error.response.get('Error', {}).get('Code')
+
+# Worker threads for issuing independent S3 requests concurrently
+EXECUTOR = ThreadPoolExecutor(max_workers=S3_MAX_CONCURRENCY)
+
+def is_valid_user_id(user_id: str) -> bool:
+    """Check that a user ID names exactly one document under a key prefix"""
+    # "a/b" would nest keys, and "." or ".." name a path segment, not a user
+    return bool(user_id) and '/' not in user_id and user_id not in ('.', '..')
+
+def user_document_key(prefix: str, user_id: str) -> str:
+    """S3 key of the document holding one user's data under the given prefix"""
+    if not is_valid_user_id(user_id):
+        raise ValueError(f"Invalid user_id: {user_id!r}")
+    return f"{prefix}{user_id}.json"
+
+# Parsed local files reused until the file changes on disk:
+# {path: ((inode, mtime_ns, size), data)}. Lets a request's write step reuse
+# the document its read step already loaded instead of reading it again.
+_LOCAL_DOCS: Dict[str, Tuple[Tuple[int, int, int], Dict[str, Any]]] = {}
+
+def _file_stamp(path: str) -> Tuple[int, int, int]:
+    """Identify the current version of a file"""
+    st = os.stat(path)
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+def read_json_from_local(path: str) -> Optional[Dict[str, Any]]:
+    """Read a JSON file, or None if it doesn't exist (for SAM Local)"""
+    try:
+        stamp = _file_stamp(path)
+    except FileNotFoundError:
+        _LOCAL_DOCS.pop(path, None)
+        return None
+
+    cached = _LOCAL_DOCS.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    with open(path, 'rb') as f:
+        data = orjson.loads(f.read())
+    _LOCAL_DOCS[path] = (stamp, data)
+    return data
+
+def write_json_to_local(path: str, data: Dict[str, Any]) -> None:
+    """Write a JSON file atomically (for SAM Local)"""
+    # Write a private temp file and rename it into place so concurrent
+    # invocations never read a partially written file
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(data))
+        os.replace(tmp_path, path)
+        _LOCAL_DOCS[path] = (_file_stamp(path), data)
+    except Exception:
+        # Callers modify the document in place before writing it
+        _LOCAL_DOCS.pop(path, None)
+        # Don't leave the temp file behind when the write or rename fails
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def read_json_from_s3(key: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """Read a JSON document and its ETag from S3, or (None, None) if it doesn't exist"""
+    s3_client = get_s3()
+
+    # Revalidate a cached copy instead of downloading and parsing it again
+    cached = _cache_get(key)
+    condition = {'IfNoneMatch': cached[0]} if cached else {}
+
+    try:
+        response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=key, **condition)
+    except ClientError as e:
+        # Match on the error code; s3_client.exceptions builds its classes
+        # from the service model on first access
+        code = _error_code(e)
+        if code == 'NoSuchKey':
+            _cache_invalidate(key)
+            return None, None
+        if cached and code in ('304', 'NotModified'):
+            return cached[1], cached[0]
+        raise
+
+    body = response['Body'].read()
+    if response.get('Metadata', {}).get('compression') == 'zstd':
+        # Contexts are not thread-safe and reads run on executor threads
+        body = zstd.ZstdDecompressor().decompress(body)
+    data = orjson.loads(body)
+    _cache_put(key, response['ETag'], data)
+    return data, response['ETag']
+
+def write_json_to_s3(key: str, data: Dict[str, Any], etag: Optional[str] = None) -> str:
+    """Write a JSON document to S3, failing if it changed since it was read"""
+    s3_client = get_s3()
+
+    body = orjson.dumps(data)
+    encoding = {}
+    if len(body) >= ZSTD_MIN_BYTES:
+        body = zstd.ZstdCompressor(level=3).compress(body)
+        encoding = {'ContentEncoding': 'zstd', 'Metadata': {'compression': 'zstd'}}
+
+    # Only overwrite the version we read; create only if nothing exists yet
+    condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+    try:
+        response = s3_client.put_object(
+            Bucket=S3_BUCKET_NAME,
+            Key=key,
+            Body=body,
+            ContentType='application/json',
+            **encoding,
+            **condition
+        )
+    except ClientError as e:
+        # The caller may have mutated the cached document before this failed
+        _cache_invalidate(key)
+        if _error_code(e) in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            raise WriteConflictError(f"{key} changed since it was read") from e
+        raise
+    except Exception:
+        # The caller may have mutated the cached document before this failed
+        _cache_invalidate(key)
+        raise
+
+    _cache_put(key, response['ETag'], data)
+    return response['ETag']
+
+def delete_json_from_s3(key: str) -> None:
+    """Delete a JSON document from S3 (a missing key is not an error)"""
+    try:
+        get_s3().delete_object(Bucket=S3_BUCKET_NAME, Key=key)
+    finally:
+        _cache_invalidate(key)
+
+def list_user_ids_from_s3(prefix: str) -> List[str]:
+    """List the user IDs that have a document under the given S3 prefix"""
+    paginator = get_s3().get_paginator('list_objects_v2')
+
+    user_ids = []
+    for page in paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.json'):
+                user_id = obj['Key'][len(prefix):-len('.json')]
+                # Skip keys no user ID could have produced, e.g. nested ones
+                if is_valid_user_id(user_id):
+                    user_ids.append(user_id)
+    return user_ids
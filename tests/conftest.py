@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pytest
+
+# The handlers import their siblings the way Lambda does, from the CodeUri root
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.pop('AWS_SAM_LOCAL', None)
+
+BUCKET = 'agent-permissions-data'
+
+
+@pytest.fixture
+def s3():
+    """A mocked bucket, with the shared client and caches reset around each test"""
+    from moto import mock_aws
+    import boto3
+    import storage
+
+    with mock_aws():
+        storage._S3_CLIENT = None
+        storage._CACHE.clear()
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+        storage._S3_CLIENT = None
+        storage._CACHE.clear()
+
+
+@pytest.fixture
+def sam_local(tmp_path, monkeypatch):
+    """Run both handlers against local files in a temporary directory"""
+    import lambda_handler
+    import profile_handler
+    import storage
+
+    monkeypatch.setattr(lambda_handler, 'IS_SAM_LOCAL', True)
+    monkeypatch.setattr(profile_handler, 'IS_SAM_LOCAL', True)
+    monkeypatch.setattr(lambda_handler, 'LOCAL_FILE_PATH', str(tmp_path / 'permissions.json'))
+    monkeypatch.setattr(profile_handler, 'LOCAL_PROFILES_FILE_PATH', str(tmp_path / 'user_profiles.json'))
+    storage._LOCAL_DOCS.clear()
+    yield tmp_path
+    storage._LOCAL_DOCS.clear()
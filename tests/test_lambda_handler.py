@@ -0,0 +1,192 @@
+import json
+
+import orjson
+
+import lambda_handler
+from conftest import BUCKET
+
+
+def call(method, path, user_id=None, body=None):
+    event = {'httpMethod': method, 'path': path,
+             'pathParameters': {'user_id': user_id} if user_id else None}
+    if body is not None:
+        event['body'] = json.dumps(body)
+    response = lambda_handler.handler(event, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def stored(s3, key):
+    return orjson.loads(s3.get_object(Bucket=BUCKET, Key=key)['Body'].read())
+
+
+def test_create_user_writes_per_user_key(s3):
+    status, _ = call('POST', '/users', body={'user_id': 'Alice'})
+
+    assert status == 201
+    document = stored(s3, 'permissions/alice.json')
+    assert document['user_id'] == 'alice'
+    assert document['permitted_agents'] == []
+
+
+def test_add_permission_updates_only_that_user(s3):
+    call('POST', '/users', body={'user_id': 'alice'})
+    call('POST', '/users', body={'user_id': 'bob'})
+
+    status, body = call('POST', '/permissions/alice/agents', 'alice', {'agent_name': 'trader'})
+
+    assert status == 200
+    assert body['data']['permitted_agents'] == ['trader']
+    assert stored(s3, 'permissions/alice.json')['permitted_agents'] == ['trader']
+    assert stored(s3, 'permissions/bob.json')['permitted_agents'] == []
+
+
+def test_get_all_permissions_lists_every_user_key(s3):
+    for user_id in ('alice', 'bob', 'carol'):
+        call('POST', '/users', body={'user_id': user_id})
+    call('POST', '/permissions/bob/agents', 'bob', {'agent_name': 'trader'})
+
+    status, body = call('GET', '/permissions')
+
+    assert status == 200
+    assert body['data']['permissions'] == {'alice': [], 'bob': ['trader'], 'carol': []}
+    assert body['data']['summary']['total_permissions'] == 1
+
+
+def test_clear_all_permissions_clears_every_user(s3):
+    for user_id in ('alice', 'bob'):
+        call('POST', '/permissions/%s/agents' % user_id, user_id, {'agent_name': 'trader'})
+
+    status, body = call('DELETE', '/permissions')
+
+    assert status == 200
+    assert sorted(body['data']['users']) == ['alice', 'bob']
+    assert stored(s3, 'permissions/alice.json')['permitted_agents'] == []
+    assert stored(s3, 'permissions/bob.json')['permitted_agents'] == []
+
+
+def test_clear_all_permissions_reports_users_it_could_not_clear(s3, monkeypatch):
+    for user_id in ('alice', 'bob'):
+        call('POST', '/permissions/%s/agents' % user_id, user_id, {'agent_name': 'trader'})
+    read = lambda_handler.read_all_permissions
+
+    def read_then_race():
+        result = read()
+        s3.put_object(Bucket=BUCKET, Key='permissions/bob.json',
+                      Body=orjson.dumps({"user_id": "bob", "permitted_agents": ["newer"]}))
+        return result
+
+    monkeypatch.setattr(lambda_handler, 'read_all_permissions', read_then_race)
+
+    status, body = call('DELETE', '/permissions')
+
+    assert status == 500
+    assert body['error']['code'] == 'PARTIAL_FAILURE'
+    assert body['error']['users_cleared'] == ['alice']
+    assert body['error']['users_failed'] == ['bob']
+    assert stored(s3, 'permissions/bob.json')['permitted_agents'] == ['newer']
+
+
+def test_add_permission_retries_after_a_concurrent_change(s3, monkeypatch):
+    call('POST', '/permissions/alice/agents', 'alice', {'agent_name': 'trader'})
+    read = lambda_handler.read_user_permissions
+    raced = []
+
+    def read_then_race(user_id):
+        result = read(user_id)
+        if not raced:
+            raced.append(True)
+            s3.put_object(Bucket=BUCKET, Key='permissions/alice.json',
+                          Body=orjson.dumps({"user_id": "alice", "permitted_agents": ["trader", "analyst"]}))
+        return result
+
+    monkeypatch.setattr(lambda_handler, 'read_user_permissions', read_then_race)
+
+    status, body = call('POST', '/permissions/alice/agents', 'alice', {'agent_name': 'writer'})
+
+    assert status == 200
+    assert body['data']['permitted_agents'] == ['trader', 'analyst', 'writer']
+    assert stored(s3, 'permissions/alice.json')['permitted_agents'] == ['trader', 'analyst', 'writer']
+
+
+def test_concurrent_create_returns_conflict(s3, monkeypatch):
+    read = lambda_handler.read_user_permissions
+
+    def read_then_race(user_id):
+        result = read(user_id)
+        s3.put_object(Bucket=BUCKET, Key=f'permissions/{user_id}.json', Body=b'{"permitted_agents":[]}')
+        return result
+
+    monkeypatch.setattr(lambda_handler, 'read_user_permissions', read_then_race)
+
+    status, body = call('POST', '/users', body={'user_id': 'alice'})
+
+    assert status == 409
+    assert body['error']['code'] == 'USER_ALREADY_EXISTS'
+
+
+def test_user_ids_with_dots_and_at_signs_are_accepted(s3):
+    status, _ = call('POST', '/users', body={'user_id': 'John.Doe@example.com'})
+    assert status == 201
+
+    status, body = call('GET', '/users/john.doe@example.com', 'john.doe@example.com')
+
+    assert status == 200
+    assert body['data']['user_id'] == 'john.doe@example.com'
+    assert stored(s3, 'permissions/john.doe@example.com.json')['permitted_agents'] == []
+
+
+def test_invalid_user_id_is_rejected_before_touching_s3(s3):
+    status, body = call('GET', '/users/..', '..')
+
+    assert status == 400
+    assert body['error']['code'] == 'INVALID_REQUEST'
+    assert s3.list_objects_v2(Bucket=BUCKET).get('KeyCount') == 0
+
+
+def test_create_user_rejects_user_id_with_slash(s3):
+    status, body = call('POST', '/users', body={'user_id': 'a/b'})
+
+    assert status == 400
+    assert body['error']['code'] == 'INVALID_REQUEST'
+
+
+def test_unknown_endpoint_returns_not_found(s3):
+    assert call('GET', '/agents')[0] == 404
+    assert call('PUT', '/permissions/alice', 'alice')[0] == 404
+    status, body = call('GET', '/users/alice/agents', 'alice')
+    assert status == 404
+    assert body['error']['code'] == 'NOT_FOUND'
+
+
+def test_user_id_falls_back_to_path_without_path_parameters(s3):
+    call('POST', '/users', body={'user_id': 'alice'})
+
+    status, body = call('GET', '/users/ALICE')
+
+    assert status == 200
+    assert body['data']['user_id'] == 'alice'
+
+
+def test_sam_local_keeps_the_single_file_layout(sam_local):
+    call('POST', '/users', body={'user_id': 'alice'})
+    status, body = call('POST', '/permissions/alice/agents', 'alice', {'agent_name': 'trader'})
+
+    assert status == 200
+    document = orjson.loads((sam_local / 'permissions.json').read_bytes())
+    assert document['permissions']['alice'] == ['trader']
+    assert 'user_123' in document['permissions']
+
+
+def test_user_exists_body_matches_the_encoder_for_every_user_id(s3):
+    for user_id in ('user_123', 'john.doe@example.com', 'quote"d'):
+        call('POST', '/users', body={'user_id': user_id})
+        event = {'httpMethod': 'GET', 'path': '/users/x', 'pathParameters': {'user_id': user_id}}
+
+        response = lambda_handler.handler(event, None)
+
+        assert response['statusCode'] == 200
+        assert response['body'] == orjson.dumps({
+            "status": "success",
+            "data": {"user_id": user_id, "exists": True},
+            "message": "User exists in the system"
+        }).decode()
@@ -0,0 +1,112 @@
+import orjson
+
+import migrate_storage
+from conftest import BUCKET
+
+LEGACY_PERMISSIONS = {
+    "last_updated": "2025-09-17T09:00:00.000000",
+    "permissions": {"abhinav": ["trader"], "quang": [], "John.Doe": ["writer"]}
+}
+
+LEGACY_PROFILES = {
+    "last_updated": "2025-09-17T10:30:00.000000",
+    "profiles": {"abhinav": {"email": "a@example.com", "first_name": "Abhinav", "last_name": "T"}}
+}
+
+
+def put_legacy(s3, permissions=LEGACY_PERMISSIONS, profiles=LEGACY_PROFILES):
+    s3.put_object(Bucket=BUCKET, Key='permissions.json', Body=orjson.dumps(permissions))
+    s3.put_object(Bucket=BUCKET, Key='user_profiles.json', Body=orjson.dumps(profiles))
+
+
+def stored(s3, key):
+    return orjson.loads(s3.get_object(Bucket=BUCKET, Key=key)['Body'].read())
+
+
+def keys(s3):
+    return sorted(obj['Key'] for obj in s3.list_objects_v2(Bucket=BUCKET).get('Contents', []))
+
+
+def test_splits_legacy_files_into_per_user_keys(s3):
+    put_legacy(s3)
+
+    permissions = migrate_storage.migrate_permissions()
+    profiles = migrate_storage.migrate_profiles()
+
+    assert sorted(permissions['created']) == ['abhinav', 'john.doe', 'quang']
+    assert profiles['created'] == ['abhinav']
+    assert stored(s3, 'permissions/abhinav.json') == {
+        "user_id": "abhinav",
+        "permitted_agents": ["trader"],
+        "last_updated": "2025-09-17T09:00:00.000000"
+    }
+    assert stored(s3, 'profiles/abhinav.json') == LEGACY_PROFILES['profiles']['abhinav']
+
+
+def test_mixed_case_user_ids_are_lowercased_and_combined(s3):
+    put_legacy(s3, permissions={"permissions": {"Bob": ["trader"], "bob": ["writer", "trader"]}})
+
+    result = migrate_storage.migrate_permissions()
+
+    assert result['created'] == ['bob']
+    assert stored(s3, 'permissions/bob.json')['permitted_agents'] == ['trader', 'writer']
+
+
+def test_migrated_users_are_served_by_the_handlers(s3):
+    import lambda_handler
+
+    put_legacy(s3)
+    migrate_storage.migrate_permissions()
+
+    assert lambda_handler.read_all_permissions_from_s3().keys() == {'abhinav', 'john.doe', 'quang'}
+    assert lambda_handler.read_user_permissions_from_s3('john.doe')[0] == ['writer']
+
+
+def test_merges_into_per_user_documents_written_before_the_migration(s3):
+    put_legacy(s3)
+    s3.put_object(Bucket=BUCKET, Key='permissions/abhinav.json',
+                  Body=orjson.dumps({"user_id": "abhinav", "permitted_agents": ["newer"]}))
+    s3.put_object(Bucket=BUCKET, Key='profiles/abhinav.json',
+                  Body=orjson.dumps({"email": "new@example.com", "first_name": "Abhinav"}))
+
+    permissions = migrate_storage.migrate_permissions()
+    profiles = migrate_storage.migrate_profiles()
+
+    assert permissions['merged'] == ['abhinav']
+    assert stored(s3, 'permissions/abhinav.json')['permitted_agents'] == ['newer', 'trader']
+    assert profiles['merged'] == ['abhinav']
+    assert stored(s3, 'profiles/abhinav.json') == {
+        "email": "new@example.com", "first_name": "Abhinav", "last_name": "T"
+    }
+
+
+def test_migrated_legacy_files_are_renamed_so_reruns_do_nothing(s3):
+    put_legacy(s3)
+    migrate_storage.migrate_permissions()
+    migrate_storage.migrate_profiles()
+
+    # A cleared user must stay cleared when the migration runs again
+    s3.put_object(Bucket=BUCKET, Key='permissions/abhinav.json',
+                  Body=orjson.dumps({"user_id": "abhinav", "permitted_agents": []}))
+    assert migrate_storage.migrate_permissions()['created'] == []
+
+    assert stored(s3, 'permissions/abhinav.json')['permitted_agents'] == []
+    assert 'permissions.json' not in keys(s3)
+    assert 'permissions.json.migrated' in keys(s3)
+    assert 'user_profiles.json.migrated' in keys(s3)
+
+
+def test_invalid_user_ids_are_reported_and_the_legacy_file_kept(s3):
+    put_legacy(s3, permissions={"permissions": {"abhinav": ["trader"], "bad/id": ["x"], "..": []}})
+
+    result = migrate_storage.migrate_permissions()
+
+    assert result['created'] == ['abhinav']
+    assert result['invalid'] == ['bad/id', '..']
+    assert 'permissions.json' in keys(s3)
+    assert migrate_storage.main() == 1
+
+
+def test_missing_legacy_files_are_a_no_op(s3):
+    assert migrate_storage.migrate_permissions() == {"created": [], "merged": [], "unchanged": [], "invalid": []}
+    assert keys(s3) == []
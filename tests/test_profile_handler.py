@@ -0,0 +1,127 @@
+import json
+
+import orjson
+
+import profile_handler
+from conftest import BUCKET
+
+PROFILE = {'email': 'alice@example.com', 'first_name': 'Alice', 'last_name': 'Smith'}
+
+
+def call(method, path, user_id=None, body=None):
+    event = {'httpMethod': method, 'path': path,
+             'pathParameters': {'user_id': user_id} if user_id else None}
+    if body is not None:
+        event['body'] = json.dumps(body)
+    response = profile_handler.handler(event, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def stored(s3, key):
+    return orjson.loads(s3.get_object(Bucket=BUCKET, Key=key)['Body'].read())
+
+
+def test_create_profile_writes_per_user_key(s3):
+    status, body = call('POST', '/profiles', body=PROFILE)
+
+    assert status == 201
+    assert body['data']['user_id'] == 'alice'
+    assert stored(s3, 'profiles/alice.json')['email'] == 'alice@example.com'
+
+
+def test_list_profiles_reads_every_user_key(s3):
+    call('POST', '/profiles', body=PROFILE)
+    call('POST', '/profiles', body={**PROFILE, 'first_name': 'Bob', 'email': 'bob@example.com'})
+
+    status, body = call('GET', '/profiles')
+
+    assert status == 200
+    assert body['data']['total_count'] == 2
+    assert sorted(p['user_id'] for p in body['data']['profiles']) == ['alice', 'bob']
+
+
+def test_update_profile_rewrites_only_that_user(s3):
+    call('POST', '/profiles', body=PROFILE)
+
+    status, body = call('PUT', '/profiles/alice', 'alice', {'company': 'Acme'})
+
+    assert status == 200
+    assert body['data']['profile']['company'] == 'Acme'
+    assert stored(s3, 'profiles/alice.json')['company'] == 'Acme'
+
+
+def test_update_profile_retries_after_a_concurrent_change(s3, monkeypatch):
+    call('POST', '/profiles', body=PROFILE)
+    read = profile_handler.read_profile
+    raced = []
+
+    def read_then_race(user_id):
+        result = read(user_id)
+        if not raced:
+            raced.append(True)
+            s3.put_object(Bucket=BUCKET, Key='profiles/alice.json',
+                          Body=orjson.dumps({**PROFILE, 'role': 'Analyst'}))
+        return result
+
+    monkeypatch.setattr(profile_handler, 'read_profile', read_then_race)
+
+    status, body = call('PUT', '/profiles/alice', 'alice', {'company': 'Acme'})
+
+    assert status == 200
+    assert stored(s3, 'profiles/alice.json')['role'] == 'Analyst'
+    assert stored(s3, 'profiles/alice.json')['company'] == 'Acme'
+
+
+def test_concurrent_create_returns_conflict(s3, monkeypatch):
+    read = profile_handler.read_profile
+
+    def read_then_race(user_id):
+        result = read(user_id)
+        s3.put_object(Bucket=BUCKET, Key=f'profiles/{user_id}.json', Body=orjson.dumps(PROFILE))
+        return result
+
+    monkeypatch.setattr(profile_handler, 'read_profile', read_then_race)
+
+    status, body = call('POST', '/profiles', body=PROFILE)
+
+    assert status == 409
+    assert body['error']['code'] == 'PROFILE_ALREADY_EXISTS'
+
+
+def test_delete_profile_deletes_the_object(s3):
+    call('POST', '/profiles', body=PROFILE)
+
+    status, _ = call('DELETE', '/profiles/alice', 'alice')
+
+    assert status == 200
+    assert s3.list_objects_v2(Bucket=BUCKET).get('KeyCount') == 0
+    assert call('GET', '/profiles/alice', 'alice')[0] == 404
+
+
+def test_invalid_user_id_is_rejected(s3):
+    status, body = call('GET', '/profiles/..', '..')
+
+    assert status == 400
+    assert body['error']['code'] == 'INVALID_REQUEST'
+
+
+def test_unknown_endpoint_returns_not_found(s3):
+    assert call('DELETE', '/profiles')[0] == 404
+    assert call('GET', '/profiles/alice/extra')[0] == 404
+
+
+def test_sam_local_create_and_delete(sam_local):
+    assert call('POST', '/profiles', body=PROFILE)[0] == 201
+    assert call('DELETE', '/profiles/alice', 'alice')[0] == 200
+
+    document = orjson.loads((sam_local / 'user_profiles.json').read_bytes())
+    assert document['profiles'] == {}
+
+
+def test_invalid_profile_data_is_rejected(s3):
+    for profile in ({**PROFILE, 'email': 'alice@example'}, {**PROFILE, 'email': 'a b@example.com'},
+                    {**PROFILE, 'first_name': 'Mary Ann'}, {**PROFILE, 'first_name': 'Zoë'}):
+        status, body = call('POST', '/profiles', body=profile)
+
+        assert status == 400
+        assert body['error']['code'] == 'INVALID_REQUEST'
@@ -0,0 +1,100 @@
+import os
+
+import orjson
+import pytest
+
+import storage
+from conftest import BUCKET
+
+
+def test_unchanged_document_is_revalidated_not_downloaded(s3, monkeypatch):
+    s3.put_object(Bucket=BUCKET, Key='doc.json', Body=b'{"n":1}')
+    first, etag = storage.read_json_from_s3('doc.json')
+    monkeypatch.setattr(storage, 'orjson', None)
+
+    # Parsing would fail now; a 304 must hand back the cached copy
+    second, second_etag = storage.read_json_from_s3('doc.json')
+
+    assert second is first
+    assert second_etag == etag
+
+
+def test_changed_document_is_downloaded_again(s3):
+    s3.put_object(Bucket=BUCKET, Key='doc.json', Body=b'{"n":1}')
+    storage.read_json_from_s3('doc.json')
+    s3.put_object(Bucket=BUCKET, Key='doc.json', Body=b'{"n":2}')
+
+    data, _ = storage.read_json_from_s3('doc.json')
+
+    assert data == {"n": 2}
+
+
+def test_missing_document_reads_as_none(s3):
+    assert storage.read_json_from_s3('missing.json') == (None, None)
+
+
+def test_write_conflicts_with_a_concurrent_write(s3):
+    etag = storage.write_json_to_s3('doc.json', {"n": 1})
+    s3.put_object(Bucket=BUCKET, Key='doc.json', Body=b'{"n":2}')
+
+    with pytest.raises(storage.WriteConflictError):
+        storage.write_json_to_s3('doc.json', {"n": 3}, etag)
+    with pytest.raises(storage.WriteConflictError):
+        storage.write_json_to_s3('doc.json', {"n": 3})
+
+
+def test_list_user_ids_skips_nested_keys(s3):
+    for key in ('p/alice.json', 'p/john.doe.json', 'p/nested/bob.json', 'p/notes.txt'):
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b'{}')
+
+    assert sorted(storage.list_user_ids_from_s3('p/')) == ['alice', 'john.doe']
+
+
+@pytest.mark.parametrize('user_id', ['', '.', '..', 'a/b'])
+def test_unsafe_user_ids_have_no_document_key(user_id):
+    with pytest.raises(ValueError):
+        storage.user_document_key('permissions/', user_id)
+
+
+def test_local_read_reuses_the_parsed_file_until_it_changes(tmp_path):
+    path = str(tmp_path / 'doc.json')
+    storage.write_json_to_local(path, {"n": 1})
+
+    first = storage.read_json_from_local(path)
+    assert storage.read_json_from_local(path) is first
+
+    with open(path, 'wb') as f:
+        f.write(orjson.dumps({"n": 22}))
+    assert storage.read_json_from_local(path) == {"n": 22}
+
+
+def test_failed_local_write_leaves_no_temp_file(tmp_path):
+    # Renaming a file over a directory fails after the temp file is written
+    path = tmp_path / 'doc.json'
+    path.mkdir()
+
+    with pytest.raises(OSError):
+        storage.write_json_to_local(str(path), {"n": 1})
+
+    assert os.listdir(tmp_path) == ['doc.json']
+
+
+def test_large_documents_round_trip_zstd_compressed(s3):
+    data = {"permitted_agents": [f"agent-{i}" for i in range(200)]}
+    assert len(orjson.dumps(data)) >= storage.ZSTD_MIN_BYTES
+
+    storage.write_json_to_s3('big.json', data)
+    storage._CACHE.clear()
+
+    raw = s3.get_object(Bucket=BUCKET, Key='big.json')
+    assert raw['Metadata'] == {'compression': 'zstd'}
+    assert len(raw['Body'].read()) < len(orjson.dumps(data))
+    assert storage.read_json_from_s3('big.json')[0] == data
+
+
+def test_small_documents_are_stored_uncompressed(s3):
+    storage.write_json_to_s3('small.json', {"n": 1})
+
+    raw = s3.get_object(Bucket=BUCKET, Key='small.json')
+    assert raw['Metadata'] == {}
+    assert orjson.loads(raw['Body'].read()) == {"n": 1}